@@ -45,6 +45,8 @@ bda_aug_conf = dict(
     flip_dy_ratio=0.5,
     flip_dz_ratio=0
 )
+# the encoders skip the bda transform unless the annotations are augmented
+apply_bda = False
 
 data_config={
     'input_size': (384, 1408),
@@ -62,7 +64,7 @@ train_pipeline = [
     dict(type='LoadMultiViewImageFromFiles_KITTI360', data_config=data_config, load_stereo_depth=True,
          is_train=True, color_jitter=(0.4, 0.4, 0.4)),
     dict(type='CreateDepthFromLiDAR_KITTI360', data_root=data_root, dataset='kitti360'),
-    dict(type='LoadKITTI360Annotation', bda_aug_conf=bda_aug_conf, apply_bda=False,
+    dict(type='LoadKITTI360Annotation', bda_aug_conf=bda_aug_conf, apply_bda=apply_bda,
             is_train=True, point_cloud_range=point_cloud_range),
     dict(type='CollectData', keys=['img_inputs', 'gt_occ'], 
             meta_keys=['pc_range', 'occ_size', 'raw_img', 'stereo_depth']),
@@ -85,7 +87,7 @@ test_pipeline = [
     dict(type='LoadMultiViewImageFromFiles_KITTI360', data_config=data_config, load_stereo_depth=True,
          is_train=False, color_jitter=None),
     dict(type='CreateDepthFromLiDAR_KITTI360', data_root=data_root, dataset='kitti360'),
-    dict(type='LoadKITTI360Annotation', bda_aug_conf=bda_aug_conf, apply_bda=False,
+    dict(type='LoadKITTI360Annotation', bda_aug_conf=bda_aug_conf, apply_bda=apply_bda,
             is_train=False, point_cloud_range=point_cloud_range),
     dict(type='CollectData', keys=['img_inputs', 'gt_occ'], 
             meta_keys=['pc_range', 'occ_size', 'sequence', 'frame_id', 'raw_img', 'stereo_depth']),
@@ -206,6 +208,7 @@ model = dict(
                num_layers=_num_layers_cross_,
                pc_range=point_cloud_range,
                data_config=data_config,
+               use_bda=apply_bda,
                num_points_in_pillar=8,
                return_intermediate=False,
                transformerlayers=dict(
@@ -247,6 +250,7 @@ model = dict(
                num_layers=_num_layers_self_,
                pc_range=point_cloud_range,
                data_config=data_config,
+               use_bda=apply_bda,
                num_points_in_pillar=8,
                return_intermediate=False,
                transformerlayers=dict(
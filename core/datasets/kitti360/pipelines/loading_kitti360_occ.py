@@ -2,6 +2,7 @@ import torch
 import numpy as np
 from PIL import Image
 from mmdet.datasets.builder import PIPELINES
+from core.utils.cam_params import pack_cam_params
 
 @PIPELINES.register_module()
 class LoadKITTI360Annotation():
@@ -29,7 +30,7 @@ class LoadKITTI360Annotation():
         bda_rot = torch.eye(4).float()
         imgs, rots, trans, intrins, post_rots, post_trans, gt_depths, sensor2sensors, focal_length, baseline = results['img_inputs']
 
-        results['img_inputs'] = (imgs, rots, trans, intrins, post_rots, post_trans, bda_rot, imgs.shape[-2:], gt_depths, sensor2sensors, focal_length, baseline)
+        results['img_inputs'] = (imgs, pack_cam_params(rots, trans, intrins, post_rots, post_trans, bda_rot), imgs.shape[-2:], gt_depths, sensor2sensors, focal_length, baseline)
         return results
     
     def __call__(self, results):
@@ -52,7 +53,7 @@ class LoadKITTI360Annotation():
             bda_rot = torch.eye(4).float()
         
         imgs, rots, trans, intrins, post_rots, post_trans, gt_depths, sensor2sensors, focal_length, baseline = results['img_inputs']
-        results['img_inputs'] = (imgs, rots, trans, intrins, post_rots, post_trans, bda_rot, imgs.shape[-2:], gt_depths, sensor2sensors, focal_length, baseline)
+        results['img_inputs'] = (imgs, pack_cam_params(rots, trans, intrins, post_rots, post_trans, bda_rot), imgs.shape[-2:], gt_depths, sensor2sensors, focal_length, baseline)
 
         results['gt_occ'] = gt_occ.long()
         # results['gt_occ_1_2'] = gt_occ_1_2.long()
@@ -4,6 +4,7 @@ from mmdet.models import DETECTORS
 from mmdet3d.models import builder
 from mmcv.runner import force_fp32
 import os
+from core.utils.cam_params import unpack_cam_params
 @DETECTORS.register_module()
 class CGFormer(BaseModule):
     def __init__(
@@ -81,7 +82,8 @@ class CGFormer(BaseModule):
         img = img_inputs[0]
         img_enc_feats = self.image_encoder(img)
 
-        rots, trans, intrins, post_rots, post_trans, bda = img_inputs[1:7]
+        # camera params come packed from the dataloader, see `pack_cam_params`
+        rots, trans, intrins, post_rots, post_trans, bda = unpack_cam_params(img_inputs[1])
         mlp_input = self.depth_net.get_mlp_input(rots, trans, intrins, post_rots, post_trans, bda)
 
         geo_inputs = [rots, trans, intrins, post_rots, post_trans, bda, mlp_input]
@@ -26,7 +26,7 @@ from mmcv.runner import force_fp32, auto_fp16
 from mmcv.runner.base_module import BaseModule, ModuleList, Sequential
 from mmcv.utils import ext_loader
 from .multi_scale_deformable_attn_function import MultiScaleDeformableAttnFunction_fp32, \
-    MultiScaleDeformableAttnFunction_fp16
+    MultiScaleDeformableAttnFunction_fp16, ms_deform_attn_fp32
 
 from .multi_scale_3ddeformable_attn_function import WeightedMultiScaleDeformableAttnFunction_fp32, \
     WeightedMultiScaleDeformableAttnFunction_fp16, MultiScaleDepthScoreSampleFunction_fp32, MultiScaleDepthScoreSampleFunction_fp16, \
@@ -390,11 +390,7 @@ class MSDeformableAttention3D(BaseModule):
         #
 
         if torch.cuda.is_available() and value.is_cuda:
-            if value.dtype == torch.float16:
-                MultiScaleDeformableAttnFunction = MultiScaleDeformableAttnFunction_fp32
-            else:
-                MultiScaleDeformableAttnFunction = MultiScaleDeformableAttnFunction_fp32
-            output = MultiScaleDeformableAttnFunction.apply(
+            output = ms_deform_attn_fp32(
                 value, spatial_shapes, level_start_index, sampling_locations,
                 attention_weights, self.im2col_step)
         else:
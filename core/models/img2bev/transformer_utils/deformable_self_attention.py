@@ -10,7 +10,7 @@
 #  Modified by Zhiqi Li
 # ---------------------------------------------
 
-from .multi_scale_deformable_attn_function import MultiScaleDeformableAttnFunction_fp32
+from .multi_scale_deformable_attn_function import ms_deform_attn_fp32
 from mmcv.ops.multi_scale_deform_attn import multi_scale_deformable_attn_pytorch
 import warnings
 import torch
@@ -182,7 +182,7 @@ class DeformSelfAttention(BaseModule):
         if value is None:
             assert self.batch_first
             bs, len_bev, c = query.shape
-            value = torch.stack([query, query], 1).reshape(bs*2, len_bev, c)
+            value = query.unsqueeze(1).expand(bs, 2, len_bev, c).reshape(bs*2, len_bev, c)
 
             # value = torch.cat([query, query], 0)
 
@@ -245,11 +245,7 @@ class DeformSelfAttention(BaseModule):
         if torch.cuda.is_available() and value.is_cuda:
 
             # using fp16 deformable attention is unstable because it performs many sum operations
-            if value.dtype == torch.float16:
-                MultiScaleDeformableAttnFunction = MultiScaleDeformableAttnFunction_fp32
-            else:
-                MultiScaleDeformableAttnFunction = MultiScaleDeformableAttnFunction_fp32
-            output = MultiScaleDeformableAttnFunction.apply(
+            output = ms_deform_attn_fp32(
                 value, spatial_shapes, level_start_index, sampling_locations,
                 attention_weights, self.im2col_step)
         else:
@@ -28,6 +28,47 @@ ext_module = ext_loader.load_ext(
     '_ext', ['ms_deform_attn_backward', 'ms_deform_attn_forward'])
 
 
+@torch.jit.script
+def fused_point_sampling(reference_points, lidar2img_rot, lidar2img_tran, post_rot, post_tran,
+                         inv_img_h: float, inv_img_w: float, eps: float):
+    """Project lidar points to the normalized image plane as one elementwise map.
+
+    The 3x3 / 2x2 products are written out per component so that the
+    TorchScript fuser can emit projection, perspective divide, image
+    augmentation, normalization and the visibility mask as a single
+    kernel, reading each point once and writing the outputs directly in the
+    layout used by the cross attention.
+    Args:
+        reference_points (Tensor): lidar points, (B, D, num_query, 3).
+        lidar2img_rot, lidar2img_tran (Tensor): (B, num_cam, 3, 3) / (B, num_cam, 3).
+        post_rot, post_tran (Tensor): (B, num_cam, 2, 2) / (B, num_cam, 2).
+        inv_img_h, inv_img_w (float): reciprocal of the input image size.
+    Returns:
+        tuple[Tensor]: reference_points_cam with shape
+            (num_cam, B, num_query, D, 2) and volume_mask with shape
+            (num_cam, B, num_query, D).
+    """
+    # [B, D, num_query, 3] -> [1, B, num_query, D] per coordinate
+    points = reference_points.transpose(1, 2).unsqueeze(0)
+    x, y, z = points[..., 0], points[..., 1], points[..., 2]
+    # [B, num_cam, ...] -> [num_cam, B, 1, 1, ...]
+    rot = lidar2img_rot.transpose(0, 1)[:, :, None, None]
+    tran = lidar2img_tran.transpose(0, 1)[:, :, None, None]
+    prot = post_rot.transpose(0, 1)[:, :, None, None]
+    ptran = post_tran.transpose(0, 1)[:, :, None, None]
+
+    d = rot[..., 2, 0] * x + rot[..., 2, 1] * y + rot[..., 2, 2] * z + tran[..., 2]
+    d_clamped = d.clamp_min(eps)
+    u = (rot[..., 0, 0] * x + rot[..., 0, 1] * y + rot[..., 0, 2] * z + tran[..., 0]) / d_clamped
+    v = (rot[..., 1, 0] * x + rot[..., 1, 1] * y + rot[..., 1, 2] * z + tran[..., 1]) / d_clamped
+
+    u_img = (prot[..., 0, 0] * u + prot[..., 0, 1] * v + ptran[..., 0]) * inv_img_w
+    v_img = (prot[..., 1, 0] * u + prot[..., 1, 1] * v + ptran[..., 1]) * inv_img_h
+
+    volume_mask = (d > eps) & (u_img > eps) & (u_img < 1.0 - eps) & (v_img > eps) & (v_img < 1.0 - eps)
+    return torch.stack([u_img, v_img], -1), volume_mask
+
+
 @TRANSFORMER_LAYER_SEQUENCE.register_module()
 class VoxFormerEncoder(TransformerLayerSequence):
 
@@ -37,6 +78,32 @@ class VoxFormerEncoder(TransformerLayerSequence):
         return_intermediate (bool): Whether to return intermediate outputs.
         coder_norm_cfg (dict): Config of last normalization layer. Default：
             `LN`.
+        compile_cfg (dict, optional): If given, each layer is wrapped with
+            `torch.compile(layer, **compile_cfg)`, e.g.
+            dict(mode='reduce-overhead'). Requires PyTorch >= 2.0. From
+            PyTorch 2.4 the 2D deformable attention is traced as the
+            `voxformer::ms_deform_attn` custom op, the DFA3D ops stay graph
+            breaks. Default: None.
+        assume_orthonormal (bool): Whether the camera rotations `rots` are
+            pure rotations, so that their inverse is their transpose.
+            Default: True.
+        fp16_ref_points_cam (bool): Whether to hand the normalized image
+            reference points to the cross attention in fp16, halving the
+            memory traffic of the per-camera rebatching. For points inside
+            the image (the ones kept by bev_mask) u and v are in [0, 1], so
+            the error stays below 5e-4 of the image size. The DFA3D variant
+            also casts its depth channel, (d - d_bound[0]) / (d_bound[1] -
+            d_bound[0]), which is in [0, 1] for depths inside d_bound, i.e.
+            an error below 5e-4 of the depth range (about 3cm for the
+            default [2, 58]). Points off the image or outside d_bound are
+            unbounded and may lose precision or overflow to inf, but they
+            still fall outside the sampled features.
+            Default: False.
+        use_bda (bool): Whether the inputs carry a bev data augmentation,
+            if not bda is taken as identity and never touched. Must match
+            the `apply_bda` of the annotation loading pipeline. The packed
+            camera params (see `core.utils.cam_params`) always hold bda as
+            (B, 4, 4). Default: True.
     """
 
     def __init__(
@@ -47,6 +114,10 @@ class VoxFormerEncoder(TransformerLayerSequence):
         num_points_in_pillar=4, 
         return_intermediate=False, 
         dataset_type='nuscenes',
+        compile_cfg=None,
+        assume_orthonormal=True,
+        fp16_ref_points_cam=False,
+        use_bda=True,
         **kwargs):
 
         super(VoxFormerEncoder, self).__init__(*args, **kwargs)
@@ -55,8 +126,38 @@ class VoxFormerEncoder(TransformerLayerSequence):
         self.num_points_in_pillar = num_points_in_pillar
 
         self.final_dim = data_config['input_size']
+        # multiplied instead of dividing by the image size
+        ogfH, ogfW = self.final_dim # [384, 1280]
+        self._inv_img_h = 1.0 / ogfH
+        self._inv_img_w = 1.0 / ogfW
         self.pc_range = pc_range
+        self.assume_orthonormal = assume_orthonormal
+        self.fp16_ref_points_cam = fp16_ref_points_cam
+        self.use_bda = use_bda
+        # whether bda is used is fixed for a run, so pick the specialized transform once
+        if use_bda:
+            self._project_fn = self._project_bda_4x4
+        else:
+            self._project_fn = self._project_no_bda
+        if pc_range is not None:
+            # maps normalized reference points to lidar coordinates
+            self.register_buffer('pc_scale', torch.tensor(
+                [pc_range[3] - pc_range[0], pc_range[4] - pc_range[1], pc_range[5] - pc_range[2]],
+                dtype=torch.float), persistent=False)
+            self.register_buffer('pc_offset', torch.tensor(pc_range[:3], dtype=torch.float), persistent=False)
         self.fp16_enabled = False
+        # forward constants built once: the bev grid, keyed on (H, W, bs, device, dtype),
+        # and the bev spatial shapes, keyed on ('spatial_shapes', H, W, device)
+        self._ref_cache = {}
+
+        self.compiled_layers = None
+        if compile_cfg is not None:
+            if digit_version(TORCH_VERSION) >= digit_version('2.0.0'):
+                # a plain list, so the compiled wrappers do not show up in the state dict
+                self.compiled_layers = [torch.compile(layer, **compile_cfg) for layer in self.layers]
+            else:
+                warnings.warn(f'torch.compile requires PyTorch >= 2.0, but got {TORCH_VERSION}, '
+                              f'{self.__class__.__name__} runs its layers eagerly.')
 
     @staticmethod
     def get_reference_points(H, W, Z=8, num_points_in_pillar=4, dim='3d', bs=1, device='cuda', dtype=torch.float):
@@ -74,15 +175,13 @@ class VoxFormerEncoder(TransformerLayerSequence):
 
         # reference points in 3D space, used in spatial cross-attention (SCA)
         if dim == '3d':
-            zs = torch.linspace(0.5, Z - 0.5, num_points_in_pillar, dtype=dtype,
-                                device=device).view(-1, 1, 1).expand(num_points_in_pillar, H, W) / Z
-            xs = torch.linspace(0.5, W - 0.5, W, dtype=dtype,
-                                device=device).view(1, 1, W).expand(num_points_in_pillar, H, W) / W
-            ys = torch.linspace(0.5, H - 0.5, H, dtype=dtype,
-                                device=device).view(1, H, 1).expand(num_points_in_pillar, H, W) / H
-            ref_3d = torch.stack((xs, ys, zs), -1)
-            ref_3d = ref_3d.permute(0, 3, 1, 2).flatten(2).permute(0, 2, 1)
-            ref_3d = ref_3d[None].repeat(bs, 1, 1, 1)
+            zs = torch.linspace(0.5, Z - 0.5, num_points_in_pillar, dtype=dtype, device=device) / Z
+            ys = torch.linspace(0.5, H - 0.5, H, dtype=dtype, device=device) / H
+            xs = torch.linspace(0.5, W - 0.5, W, dtype=dtype, device=device) / W
+            zs, ys, xs = torch.meshgrid(zs, ys, xs, indexing='ij')
+            # [num_points_in_pillar, H*W, 3], shared by the batch as a view
+            ref_3d = torch.stack((xs, ys, zs), -1).reshape(num_points_in_pillar, H * W, 3)
+            ref_3d = ref_3d[None].expand(bs, -1, -1, -1)
             return ref_3d
 
         # reference points on 2D bev plane, used in temporal self-attention (TSA).
@@ -99,70 +198,67 @@ class VoxFormerEncoder(TransformerLayerSequence):
             ref_2d = ref_2d.repeat(bs, 1, 1).unsqueeze(2)
             return ref_2d
 
+    def get_inverse_transforms(self, rots, bda):
+        """Get the inverses of bda and rots.
+        Args:
+            rots (Tensor): camera to lidar rotations, (B, num_cam, 3, 3).
+            bda (Tensor): bev data augmentation matrix, (B, 4, 4).
+        Returns:
+            tuple[Tensor]: inv_bda with the shape of bda (None without
+                `use_bda`) and inv_rots with the shape of rots.
+        """
+        inv_bda = torch.linalg.inv(bda) if self.use_bda else None
+        if self.assume_orthonormal:
+            # rots comes from a rigid lidar <-> camera transform, R^-1 = R^T
+            inv_rots = rots.transpose(-1, -2)
+        else:
+            inv_rots = torch.linalg.inv(rots)
+        return inv_bda, inv_rots
+
+    def get_lidar2img(self, rots, trans, intrins, bda):
+        """Compose bda^-1, the lidar to camera transform and the intrinsics
+        into a single affine map, so that [u*d, v*d, d] = rot @ p + tran for
+        a (bda augmented) lidar point p.
+        Args:
+            rots, trans: camera to lidar transform, (B, num_cam, 3, 3) / (B, num_cam, 3).
+            intrins (Tensor): camera intrinsics, (B, num_cam, 3, 3) / (B, num_cam, 4, 4).
+            bda (Tensor): bev data augmentation matrix, (B, 4, 4).
+        Returns:
+            tuple[Tensor]: rot with shape (B, num_cam, 3, 3) and tran with
+                shape (B, num_cam, 3).
+        """
+        inv_bda, inv_rots = self.get_inverse_transforms(rots, bda)
+        cam2img = intrins[..., :3, :3] @ inv_rots
+        lidar2img_rot, lidar2img_tran = self._project_fn(inv_bda, cam2img, trans)
+        if intrins.shape[3] == 4:
+            lidar2img_tran = lidar2img_tran + intrins[..., :3, 3]
+        return lidar2img_rot, lidar2img_tran
+
+    def _project_no_bda(self, inv_bda, cam2img, trans):
+        return cam2img, torch.einsum('bnij,bnj->bni', cam2img, -trans)
+
+    def _project_bda_4x4(self, inv_bda, cam2img, trans):
+        lidar2img_rot = cam2img @ inv_bda[:, None, :3, :3]
+        lidar2img_tran = torch.einsum('bnij,bnj->bni', cam2img, inv_bda[:, None, :3, 3] - trans)
+        return lidar2img_rot, lidar2img_tran
+
     # This function must use fp32!!!
     @force_fp32(apply_to=('reference_points', 'img_metas'))
-    def point_sampling(self, reference_points, pc_range, cam_params, img_metas=None):
+    def point_sampling(self, reference_points, cam_params, img_metas=None):
 
         rots, trans, intrins, post_rots, post_trans, bda = cam_params
-        B, num_cam, _ = trans.shape
         eps = 1e-5
-        ogfH, ogfW = self.final_dim # [384, 1280]
 
-        # [bs, 1, HWZ, 3] / [bs, D, HWZ, 3]
-        reference_points[..., 0:1] = reference_points[..., 0:1] * \
-            (pc_range[3] - pc_range[0]) + pc_range[0]
-        reference_points[..., 1:2] = reference_points[..., 1:2] * \
-            (pc_range[4] - pc_range[1]) + pc_range[1]
-        reference_points[..., 2:3] = reference_points[..., 2:3] * \
-            (pc_range[5] - pc_range[2]) + pc_range[2]
-        
-        # [bs, D, HWZ, 3] -> [D, bs, HWZ, 3]
-        reference_points = reference_points.permute(1, 0, 2, 3)
-        D, B, num_query = reference_points.size()[:3]
-
-        # [D, B, num_cam, num_query, 3]
-        reference_points = reference_points.view(
-            D, B, 1, num_query, 3).repeat(1, 1, num_cam, 1, 1)
-
-        if bda.shape[-1] == 4:
-            # [D, B, num_cam, num_query, 4]
-            reference_points = torch.cat((reference_points, torch.ones(*reference_points.shape[:-1], 1).type_as(reference_points)), dim=-1)
-            reference_points = torch.inverse(bda).view(1, B, 1, 1, 4, 4).matmul(reference_points.unsqueeze(-1)).squeeze(-1)
-            reference_points = reference_points[..., :3]
-        else:
-            reference_points = torch.inverse(bda).view(1, B, 1, 1, 3, 3).matmul(reference_points.unsqueeze(-1)).squeeze(-1)
-        
-        reference_points = reference_points - trans.view(1, B, num_cam, 1, 3)
-        inv_rots = rots.inverse().view(1, B, num_cam, 1, 3, 3)
-        reference_points = (inv_rots @ reference_points.unsqueeze(-1)).squeeze(-1)
+        # [bs, 1, HWZ, 3] / [bs, D, HWZ, 3], out of place so the caller's points stay normalized
+        reference_points = torch.addcmul(self.pc_offset, reference_points, self.pc_scale)
 
-        if intrins.shape[3] == 4:            
-            reference_points = torch.cat((reference_points, torch.ones(*reference_points.shape[:-1], 1).type_as(reference_points)), dim=-1)
-            reference_points_cam = (intrins.view(1, B, num_cam, 1, 4, 4) @ reference_points.unsqueeze(-1)).squeeze(-1)
-        else:
-            reference_points_cam = (intrins.view(1, B, num_cam, 1, 3, 3) @ reference_points.unsqueeze(-1)).squeeze(-1)
-        
-        points_d = reference_points_cam[..., 2:3]
-        reference_points_cam = reference_points_cam[..., 0:2] / torch.maximum(
-            points_d, torch.ones_like(reference_points_cam[..., 2:3]) * eps
-        )
-
-        reference_points_cam = post_rots[:, :, :2, :2].view(1, B, num_cam, 1, 2, 2) @ reference_points_cam.unsqueeze(-1)
-        reference_points_cam = reference_points_cam.squeeze(-1) + post_trans[:, :, :2].view(1, B, num_cam, 1, 2)
-
-        # [D, B, num_cam, num_query, 2]
-        reference_points_cam[..., 0] /= ogfW
-        reference_points_cam[..., 1] /= ogfH
-        volume_mask = (points_d > eps) #只有深度值大于 1e-5 的位置才会被标记为 True
-        # [D, B, num_cam, num_query, 1]
-        volume_mask = (volume_mask & (reference_points_cam[..., 0:1] > eps)
-                & (reference_points_cam[..., 0:1] < (1.0 - eps))
-                & (reference_points_cam[..., 1:2] > eps)
-                & (reference_points_cam[..., 1:2] < (1.0 - eps))
-                )
-        
-        reference_points_cam = reference_points_cam.permute(2, 1, 3, 0, 4) # [num_cam, B, num_query, D, 2]
-        volume_mask = volume_mask.permute(2, 1, 3, 0, 4).squeeze(-1) # [D, B, num_cam, num_query, 1] -> [num_cam, B, num_query, D]
+        # lidar -> image plane as one affine map, [B, num_cam, 3, 3] / [B, num_cam, 3]
+        lidar2img_rot, lidar2img_tran = self.get_lidar2img(rots, trans, intrins, bda)
+
+        # [num_cam, B, num_query, D, 2] / [num_cam, B, num_query, D]
+        reference_points_cam, volume_mask = fused_point_sampling(
+            reference_points, lidar2img_rot, lidar2img_tran, post_rots[:, :, :2, :2], post_trans[:, :, :2],
+            self._inv_img_h, self._inv_img_w, eps)
         return reference_points_cam, volume_mask
 
     @auto_fp16()
@@ -204,24 +300,45 @@ class VoxFormerEncoder(TransformerLayerSequence):
         output = bev_query
         intermediate = []
 
-        ref_2d = self.get_reference_points(
-            512, 512, dim='2d', bs=bev_query.size(1), device=bev_query.device, dtype=bev_query.dtype)
-
-        bs, len_bev, num_bev_level, _ = ref_2d.shape
-
-        hybird_ref_2d = torch.stack([ref_2d, ref_2d], 1).reshape(
-                bs*2, len_bev, num_bev_level, 2)
+        ref_key = (512, 512, bev_query.size(1), bev_query.device, bev_query.dtype)
+        hybird_ref_2d = self._ref_cache.get(ref_key)
+        if hybird_ref_2d is None:
+            # Built outside inference mode even if the first forward runs in it (e.g. a
+            # validation before training), a cached inference tensor would break backward
+            # in every later training step.
+            with torch.inference_mode(False):
+                ref_2d = self.get_reference_points(
+                    512, 512, dim='2d', bs=bev_query.size(1), device=bev_query.device, dtype=bev_query.dtype)
+
+                bs, len_bev, num_bev_level, _ = ref_2d.shape
+
+                # a view for bs == 1; DeformSelfAttention only broadcasts it into the sampling locations
+                hybird_ref_2d = ref_2d.unsqueeze(1).expand(-1, 2, -1, -1, -1).reshape(
+                        bs*2, len_bev, num_bev_level, 2)
+            self._ref_cache[ref_key] = hybird_ref_2d
+
+        # spatial shape of the bev queries, shared by the self attention of all layers
+        shape_key = ('spatial_shapes', bev_h, bev_w, bev_query.device)
+        bev_spatial_shapes = self._ref_cache.get(shape_key)
+        if bev_spatial_shapes is None:
+            # saved for backward by the attention ops, so never cache an inference tensor
+            with torch.inference_mode(False):
+                bev_spatial_shapes = torch.tensor([[bev_h, bev_w]], device=bev_query.device)
+            self._ref_cache[shape_key] = bev_spatial_shapes
 
-        
         reference_points_cam, bev_mask = self.point_sampling(
-            ref_3d, self.pc_range, cam_params=cam_params, img_metas=kwargs['img_metas'], )
+            ref_3d, cam_params=cam_params, img_metas=kwargs['img_metas'], )
+        if self.fp16_ref_points_cam:
+            # added to fp32 sampling offsets downstream, so the MSDA ops still get fp32 locations
+            reference_points_cam = reference_points_cam.half()
 
         # (num_query, bs, embed_dims) -> (bs, num_query, embed_dims)
         bev_query = bev_query.permute(1, 0, 2)
         if bev_pos is not None:
             bev_pos = bev_pos.permute(1, 0, 2)
 
-        for lid, layer in enumerate(self.layers):
+        layers = self.layers if self.compiled_layers is None else self.compiled_layers
+        for lid, layer in enumerate(layers):
             output = layer(
                 bev_query,
                 key,
@@ -232,6 +349,7 @@ class VoxFormerEncoder(TransformerLayerSequence):
                 ref_3d=ref_3d,
                 bev_h=bev_h,
                 bev_w=bev_w,
+                bev_spatial_shapes=bev_spatial_shapes,
                 spatial_shapes=spatial_shapes,
                 level_start_index=level_start_index,
                 reference_points_cam=reference_points_cam,
@@ -263,72 +381,61 @@ class VoxFormerEncoder_DFA3D(VoxFormerEncoder):
         super(VoxFormerEncoder_DFA3D, self).__init__(*args, pc_range=pc_range, data_config=data_config,
                          return_intermediate=return_intermediate, dataset_type=dataset_type, **kwargs)
         self.d_bound = d_bound
+        # [1/W, 1/H], scales both image coordinates in one multiply
+        self.register_buffer('_inv_img_size', torch.tensor([self._inv_img_w, self._inv_img_h]), persistent=False)
+        # same specialization as `_project_fn`, applied to the points instead
+        if self.use_bda:
+            self._undo_bda_fn = self._undo_bda_4x4
+        else:
+            self._undo_bda_fn = self._undo_no_bda
+
+    def _undo_no_bda(self, inv_bda, points):
+        return points
+
+    def _undo_bda_4x4(self, inv_bda, points):
+        points = torch.einsum('bij,bqdj->bqdi', inv_bda[:, :3, :3], points)
+        return points + inv_bda[:, None, None, :3, 3]
     
-    def point_sampling(self, reference_points, pc_range, cam_params, img_metas=None):
+    def point_sampling(self, reference_points, cam_params, img_metas=None):
 
         rots, trans, intrins, post_rots, post_trans, bda = cam_params
-        B, num_cam, _ = trans.shape
         eps = 1e-5
-        ogfH, ogfW = self.final_dim # [384, 1280]
 
-        # [bs, 1, HWZ, 3] / [bs, D, HWZ, 3]
-        reference_points[..., 0:1] = reference_points[..., 0:1] * \
-            (pc_range[3] - pc_range[0]) + pc_range[0]
-        reference_points[..., 1:2] = reference_points[..., 1:2] * \
-            (pc_range[4] - pc_range[1]) + pc_range[1]
-        reference_points[..., 2:3] = reference_points[..., 2:3] * \
-            (pc_range[5] - pc_range[2]) + pc_range[2]
+        # [bs, 1, HWZ, 3] / [bs, D, HWZ, 3], out of place so the caller's points stay normalized
+        reference_points = torch.addcmul(self.pc_offset, reference_points, self.pc_scale)
         
-        # [bs, D, HWZ, 3] -> [D, bs, HWZ, 3]
-        reference_points = reference_points.permute(1, 0, 2, 3)
-        D, B, num_query = reference_points.size()[:3]
-
-        # [D, B, num_cam, num_query, 3]
-        reference_points = reference_points.view(
-            D, B, 1, num_query, 3).repeat(1, 1, num_cam, 1, 1)
-
-        if bda.shape[-1] == 4:
-            # [D, B, num_cam, num_query, 4]
-            reference_points = torch.cat((reference_points, torch.ones(*reference_points.shape[:-1], 1).type_as(reference_points)), dim=-1)
-            reference_points = torch.inverse(bda).view(1, B, 1, 1, 4, 4).matmul(reference_points.unsqueeze(-1)).squeeze(-1)
-            reference_points = reference_points[..., :3]
-        else:
-            reference_points = torch.inverse(bda).view(1, B, 1, 1, 3, 3).matmul(reference_points.unsqueeze(-1)).squeeze(-1)
-        
-        reference_points = reference_points - trans.view(1, B, num_cam, 1, 3)
-        inv_rots = rots.inverse().view(1, B, num_cam, 1, 3, 3)
-        reference_points = (inv_rots @ reference_points.unsqueeze(-1)).squeeze(-1)
-
-        if intrins.shape[3] == 4:            
-            reference_points = torch.cat((reference_points, torch.ones(*reference_points.shape[:-1], 1).type_as(reference_points)), dim=-1)
-            reference_points_cam = (intrins.view(1, B, num_cam, 1, 4, 4) @ reference_points.unsqueeze(-1)).squeeze(-1)
-        else:
-            reference_points_cam = (intrins.view(1, B, num_cam, 1, 3, 3) @ reference_points.unsqueeze(-1)).squeeze(-1)
+        # work in the output layout from the start, [bs, D, HWZ, 3] -> [B, num_query, D, 3]
+        reference_points = reference_points.permute(0, 2, 1, 3)
+
+        # bda is shared by all cameras, so undo it before the points fan out per camera
+        inv_bda, inv_rots = self.get_inverse_transforms(rots, bda)
+        reference_points = self._undo_bda_fn(inv_bda, reference_points)
+
+        # broadcasting against the per camera translation adds the camera dim without
+        # a repeat, [num_cam, B, num_query, D, 3]
+        reference_points = reference_points - trans.transpose(0, 1)[:, :, None, None]
+        reference_points = torch.einsum('bnij,nbqdj->nbqdi', inv_rots, reference_points)
+
+        # only the first 3 rows of the intrinsics are used, so the result is
+        # [u*d, v*d, d] directly, [num_cam, B, num_query, D, 3]
+        reference_points_cam = torch.einsum('bnij,nbqdj->nbqdi', intrins[..., :3, :3], reference_points)
+        if intrins.shape[3] == 4:
+            reference_points_cam = reference_points_cam + intrins[..., :3, 3].transpose(0, 1)[:, :, None, None]
         
         points_d = reference_points_cam[..., 2:3]
-        reference_points_cam[..., 0:2] = reference_points_cam[..., 0:2] / torch.maximum(
-            points_d, torch.ones_like(reference_points_cam[..., 2:3]) * eps
-        )
+        reference_points_cam[..., 0:2] = reference_points_cam[..., 0:2] / points_d.clamp_min(eps)
 
-        reference_points_cam[..., 0:2] = (post_rots[:, :, :2, :2].view(1, B, num_cam, 1, 2, 2) @ reference_points_cam[..., 0:2].unsqueeze(-1)).squeeze(-1)
-        reference_points_cam[..., 0:2] = reference_points_cam[..., 0:2] + post_trans[:, :, :2].view(1, B, num_cam, 1, 2)
+        reference_points_cam[..., 0:2] = torch.einsum('bnij,nbqdj->nbqdi', post_rots[:, :, :2, :2], reference_points_cam[..., 0:2])
+        reference_points_cam[..., 0:2] = reference_points_cam[..., 0:2] + post_trans[:, :, :2].transpose(0, 1)[:, :, None, None]
 
-        # [D, B, num_cam, num_query, 2]
-        reference_points_cam[..., 0] /= ogfW
-        reference_points_cam[..., 1] /= ogfH
+        # [num_cam, B, num_query, D, 3]
+        reference_points_cam[..., 0:2].mul_(self._inv_img_size.to(reference_points_cam.dtype))
         reference_points_cam[..., 2] = (reference_points_cam[..., 2] - self.d_bound[0]) / (self.d_bound[1]-self.d_bound[0])
-        reference_points_cam = reference_points_cam[..., :3]
         
-        volume_mask = (points_d > eps)
-        # [D, B, num_cam, num_query, 1]
-        volume_mask = (volume_mask & (reference_points_cam[..., 0:1] > eps)
-                & (reference_points_cam[..., 0:1] < (1.0 - eps))
-                & (reference_points_cam[..., 1:2] > eps)
-                & (reference_points_cam[..., 1:2] < (1.0 - eps))
-                )
-        # print(torch.sum(volume_mask))
-        reference_points_cam = reference_points_cam.permute(2, 1, 3, 0, 4) # [num_cam, B, num_query, D, 2]
-        volume_mask = volume_mask.permute(2, 1, 3, 0, 4).squeeze(-1) # [D, B, num_cam, num_query, 1] -> [num_cam, B, num_query, D]
+        # both image coordinates are tested at once, [num_cam, B, num_query, D]
+        # note points_d is a view of the (now normalized) depth channel
+        uv = reference_points_cam[..., 0:2]
+        volume_mask = (points_d[..., 0] > eps) & ((uv > eps) & (uv < (1.0 - eps))).all(-1)
         return reference_points_cam, volume_mask
 
 @TRANSFORMER_LAYER.register_module()
@@ -372,6 +479,8 @@ class VoxFormerLayer(MyCustomBaseTransformerLayer):
             ffn_num_fcs=ffn_num_fcs,
             **kwargs)
         self.fp16_enabled = False
+        # level_start_index of the single level bev, kept as a buffer to follow the module's device
+        self.register_buffer('_zero_idx', torch.tensor([0], dtype=torch.long), persistent=False)
         # assert len(operation_order) == 6
         # assert set(operation_order) == set(
         #     ['self_attn', 'norm', 'cross_attn', 'ffn'])
@@ -390,6 +499,7 @@ class VoxFormerLayer(MyCustomBaseTransformerLayer):
                 ref_3d=None,
                 bev_h=None,
                 bev_w=None,
+                bev_spatial_shapes=None,
                 reference_points_cam=None,
                 mask=None,
                 spatial_shapes=None,
@@ -422,6 +532,9 @@ class VoxFormerLayer(MyCustomBaseTransformerLayer):
                 Defaults to None.
             key_padding_mask (Tensor): ByteTensor for `query`, with
                 shape [bs, num_keys]. Default: None.
+            bev_spatial_shapes (Tensor): [[bev_h, bev_w]] used by the
+                self attention, built from bev_h / bev_w if not given.
+                Default: None.
 
         Returns:
             Tensor: forwarded results with shape [num_queries, bs, embed_dims].
@@ -448,6 +561,9 @@ class VoxFormerLayer(MyCustomBaseTransformerLayer):
         for layer in self.operation_order:
             # temporal self attention
             if layer == 'self_attn':
+                if bev_spatial_shapes is None:
+                    bev_spatial_shapes = torch.tensor(
+                        [[bev_h, bev_w]], device=query.device)
 
                 query = self.attentions[attn_index](
                     query,
@@ -459,9 +575,8 @@ class VoxFormerLayer(MyCustomBaseTransformerLayer):
                     attn_mask=attn_masks[attn_index],
                     key_padding_mask=query_key_padding_mask,
                     reference_points=ref_2d,
-                    spatial_shapes=torch.tensor(
-                        [[bev_h, bev_w]], device=query.device),
-                    level_start_index=torch.tensor([0], device=query.device),
+                    spatial_shapes=bev_spatial_shapes,
+                    level_start_index=self._zero_idx,
                     **kwargs)
                 attn_index += 1
                 identity = query
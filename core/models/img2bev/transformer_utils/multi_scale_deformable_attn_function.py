@@ -4,10 +4,12 @@
 #  Modified by Zhiqi Li
 # ---------------------------------------------
 
+from typing import Tuple
+
 import torch
 from torch.cuda.amp import custom_bwd, custom_fwd
 from torch.autograd.function import Function, once_differentiable
-from mmcv.utils import ext_loader
+from mmcv.utils import TORCH_VERSION, digit_version, ext_loader
 ext_module = ext_loader.load_ext(
     '_ext', ['ms_deform_attn_backward', 'ms_deform_attn_forward'])
 
@@ -161,3 +163,103 @@ class MultiScaleDeformableAttnFunction_fp32(Function):
 
         return grad_value, None, None, \
             grad_sampling_loc, grad_attn_weight, None
+
+
+if digit_version(TORCH_VERSION) >= digit_version('2.4.0'):
+    # The autograd Functions above are opaque to torch.compile and break the
+    # graph around every attention call. The same kernels registered as a
+    # custom op with a fake (shape only) implementation can be traced, so the
+    # surrounding layer ops are compiled as one graph.
+
+    @torch.library.custom_op('voxformer::ms_deform_attn', mutates_args=())
+    def _ms_deform_attn(value: torch.Tensor, value_spatial_shapes: torch.Tensor,
+                        value_level_start_index: torch.Tensor, sampling_locations: torch.Tensor,
+                        attention_weights: torch.Tensor, im2col_step: int) -> torch.Tensor:
+        return ext_module.ms_deform_attn_forward(
+            value,
+            value_spatial_shapes,
+            value_level_start_index,
+            sampling_locations,
+            attention_weights,
+            im2col_step=im2col_step)
+
+    @_ms_deform_attn.register_fake
+    def _(value, value_spatial_shapes, value_level_start_index,
+          sampling_locations, attention_weights, im2col_step):
+        bs, _, num_heads, head_dims = value.shape
+        num_queries = sampling_locations.shape[1]
+        return value.new_empty(bs, num_queries, num_heads * head_dims)
+
+    @torch.library.custom_op('voxformer::ms_deform_attn_backward', mutates_args=())
+    def _ms_deform_attn_backward(
+            value: torch.Tensor, value_spatial_shapes: torch.Tensor,
+            value_level_start_index: torch.Tensor, sampling_locations: torch.Tensor,
+            attention_weights: torch.Tensor, grad_output: torch.Tensor,
+            im2col_step: int) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        grad_value = torch.zeros_like(value)
+        grad_sampling_loc = torch.zeros_like(sampling_locations)
+        grad_attn_weight = torch.zeros_like(attention_weights)
+
+        ext_module.ms_deform_attn_backward(
+            value,
+            value_spatial_shapes,
+            value_level_start_index,
+            sampling_locations,
+            attention_weights,
+            grad_output.contiguous(),
+            grad_value,
+            grad_sampling_loc,
+            grad_attn_weight,
+            im2col_step=im2col_step)
+        return grad_value, grad_sampling_loc, grad_attn_weight
+
+    @_ms_deform_attn_backward.register_fake
+    def _(value, value_spatial_shapes, value_level_start_index,
+          sampling_locations, attention_weights, grad_output, im2col_step):
+        return (torch.empty_like(value), torch.empty_like(sampling_locations),
+                torch.empty_like(attention_weights))
+
+    def _ms_deform_attn_setup_context(ctx, inputs, output):
+        value, value_spatial_shapes, value_level_start_index, \
+            sampling_locations, attention_weights, im2col_step = inputs
+        ctx.im2col_step = im2col_step
+        ctx.save_for_backward(value, value_spatial_shapes,
+                              value_level_start_index, sampling_locations,
+                              attention_weights)
+
+    def _ms_deform_attn_grad(ctx, grad_output):
+        value, value_spatial_shapes, value_level_start_index, \
+            sampling_locations, attention_weights = ctx.saved_tensors
+        grad_value, grad_sampling_loc, grad_attn_weight = _ms_deform_attn_backward(
+            value, value_spatial_shapes, value_level_start_index,
+            sampling_locations, attention_weights, grad_output, ctx.im2col_step)
+        return grad_value, None, None, \
+            grad_sampling_loc, grad_attn_weight, None
+
+    _ms_deform_attn.register_autograd(
+        _ms_deform_attn_grad, setup_context=_ms_deform_attn_setup_context)
+else:
+    _ms_deform_attn = None
+
+
+def ms_deform_attn_fp32(value, value_spatial_shapes, value_level_start_index,
+                        sampling_locations, attention_weights, im2col_step):
+    """Run `MultiScaleDeformableAttnFunction_fp32`, or the equivalent
+    `voxformer::ms_deform_attn` custom op while being compiled by
+    torch.compile (PyTorch >= 2.4), so the call is not a graph break.
+
+    Args and returns are the same as `MultiScaleDeformableAttnFunction_fp32`.
+    """
+    if _ms_deform_attn is not None and torch.compiler.is_compiling():
+        if torch.is_autocast_enabled():
+            # same as custom_fwd(cast_inputs=torch.float32)
+            value, sampling_locations, attention_weights = \
+                value.float(), sampling_locations.float(), attention_weights.float()
+            with torch.autocast('cuda', enabled=False):
+                return _ms_deform_attn(value, value_spatial_shapes, value_level_start_index,
+                                       sampling_locations, attention_weights, im2col_step)
+        return _ms_deform_attn(value, value_spatial_shapes, value_level_start_index,
+                               sampling_locations, attention_weights, im2col_step)
+    return MultiScaleDeformableAttnFunction_fp32.apply(
+        value, value_spatial_shapes, value_level_start_index,
+        sampling_locations, attention_weights, im2col_step)
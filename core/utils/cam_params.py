@@ -0,0 +1,67 @@
+import torch
+
+# per camera layout of the packed camera params, in this order
+CAM_PARAM_SHAPES = (
+    ('rots', (3, 3)),
+    ('trans', (3,)),
+    ('intrins', (4, 4)),
+    ('post_rots', (3, 3)),
+    ('post_trans', (3,)),
+    ('bda', (4, 4)),
+)
+CAM_PARAM_DIM = 56
+
+
+def pack_cam_params(rots, trans, intrins, post_rots, post_trans, bda):
+    """Pack the camera params of one sample into a single tensor.
+
+    Batched by the dataloader, this is one pinned host to device copy
+    instead of six small ones.
+
+    Args:
+        rots (Tensor): camera to lidar rotations, (N, 3, 3).
+        trans (Tensor): camera to lidar translations, (N, 3).
+        intrins (Tensor): camera intrinsics, (N, 4, 4).
+        post_rots (Tensor): image augmentation rotations, (N, 3, 3).
+        post_trans (Tensor): image augmentation translations, (N, 3).
+        bda (Tensor): bev data augmentation matrix, (4, 4). Repeated for
+            every camera.
+
+    Returns:
+        Tensor: packed camera params, (N, 56).
+    """
+    num_cam = rots.shape[0]
+    bda = bda.to(rots).view(1, 16).expand(num_cam, 16)
+    return torch.cat([
+        rots.reshape(num_cam, 9),
+        trans.reshape(num_cam, 3),
+        intrins.to(rots).reshape(num_cam, 16),
+        post_rots.reshape(num_cam, 9),
+        post_trans.reshape(num_cam, 3),
+        bda], dim=-1)
+
+
+def unpack_cam_params(cam_params):
+    """Split packed camera params back into views of each matrix.
+
+    Args:
+        cam_params (Tensor): packed camera params, (B, N, 56).
+
+    Returns:
+        tuple[Tensor]: rots (B, N, 3, 3), trans (B, N, 3),
+            intrins (B, N, 4, 4), post_rots (B, N, 3, 3),
+            post_trans (B, N, 3) and bda (B, 4, 4).
+    """
+    assert cam_params.shape[-1] == CAM_PARAM_DIM
+    B, N, _ = cam_params.shape
+    outs = []
+    start = 0
+    for _, shape in CAM_PARAM_SHAPES:
+        numel = 1
+        for s in shape:
+            numel *= s
+        outs.append(cam_params[..., start:start + numel].view(B, N, *shape))
+        start += numel
+    # bda is per sample
+    outs[-1] = outs[-1][:, 0]
+    return tuple(outs)